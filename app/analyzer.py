@@ -1,59 +1,96 @@
-import base64
 import io
+import threading
+from typing import IO
 
-import matplotlib.pyplot as plt
+import matplotlib
+import numpy as np
+
+matplotlib.use("Agg")
+
+from matplotlib import font_manager
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.collections import LineCollection
-from pyheatintegration import PinchAnalyzer, Stream, extract_x, y_range
+from matplotlib.figure import Figure
+from PIL import Image
 from pyheatintegration.line import Line
 
+matplotlib.rcParams.update({
+    "path.simplify": True,
+    "path.simplify_threshold": 1.0,
+    "agg.path.chunksize": 10000,
+})
+font_manager.findfont(font_manager.FontProperties())
+
+_fig = Figure(figsize=(6, 4), dpi=90)
+_canvas = FigureCanvasAgg(_fig)
+_ax = _fig.subplots(1, 1)
+_lock = threading.Lock()
+
+
+def _save_png(out: IO[bytes]) -> None:
+    Image.frombuffer(
+        "RGBA", _canvas.get_width_height(), _canvas.buffer_rgba(), "raw", "RGBA", 0, 1
+    ).save(out, format="PNG", compress_level=1)
+
+
+def _segments(hot_lines: list[Line], cold_lines: list[Line]) -> tuple[np.ndarray, np.ndarray]:
+    return (
+        np.asarray(hot_lines, dtype=np.float32).reshape(-1, 2, 2),
+        np.asarray(cold_lines, dtype=np.float32).reshape(-1, 2, 2),
+    )
+
+
+def _draw_tq_lines(hot_segments: np.ndarray, cold_segments: np.ndarray) -> None:
+    _ax.cla()
+    _ax.set_xlabel("Q [kW]")
+    _ax.set_ylabel("T [℃]")
+    _ax.add_collection(LineCollection(hot_segments, colors='#ff7f0e'))
+    _ax.add_collection(LineCollection(cold_segments, colors='#1f77b4'))
+    _ax.autoscale()
+    _canvas.draw()
 
-class Analyzer(PinchAnalyzer):
 
-    def __init__(self, streams: list[Stream], minimum_temp_diff: float):
-        super().__init__(streams, minimum_temp_diff)
+def _draw_vlines(hot_segments: np.ndarray, cold_segments: np.ndarray) -> None:
+    # The vlines stay inside the data limits, so the axes, ticks and lines
+    # already rasterized by _draw_tq_lines are reused and only the vlines are
+    # drawn on top of them.
+    segments = np.concatenate([hot_segments, cold_segments])
+    heats = np.unique(segments[..., 0])
 
-    def create_grand_composite_curve(self) -> bytes:
-        b = io.BytesIO()
+    vlines = np.empty((len(heats), 2, 2), dtype=np.float32)
+    vlines[:, :, 0] = heats[:, np.newaxis]
+    vlines[:, 0, 1] = segments[:, 0, 1].min()
+    vlines[:, 1, 1] = segments[:, 1, 1].max()
 
-        gcc_heats, gcc_temps = super().create_grand_composite_curve()
+    collection = LineCollection(vlines, linestyles=':', colors='k')
+    _ax.add_collection(collection, autolim=False)
+    _ax.draw_artist(collection)
 
-        fig, ax = plt.subplots(1, 1)
-        ax.set_xlabel("Q [kW]")
-        ax.set_ylabel("Shifted Temperature [℃]")
-        ax.plot(gcc_heats, gcc_temps)
-        fig.savefig(b, format="png")
 
-        return b.getbuffer()
+def render_grand_composite_curve(gcc_heats: list[float], gcc_temps: list[float]) -> bytes:
+    b = io.BytesIO()
 
-    def draw(self, hot_lines: list[Line], cold_lines: list[Line], with_vlines = False) -> bytes:
-        b = io.BytesIO()
+    with _lock:
+        _ax.cla()
+        _ax.set_xlabel("Q [kW]")
+        _ax.set_ylabel("Shifted Temperature [℃]")
+        _ax.plot(gcc_heats, gcc_temps)
+        _canvas.draw()
+        _save_png(b)
 
-        fig, ax = plt.subplots(1, 1)
-        ax.set_xlabel("Q [kW]")
-        ax.set_ylabel("T [℃]")
-        ax.add_collection(LineCollection(hot_lines, colors='#ff7f0e'))
-        ax.add_collection(LineCollection(cold_lines, colors='#1f77b4'))
-        if with_vlines:
-            ymin, ymax = y_range(hot_lines + cold_lines)
-            heats = extract_x(hot_lines + cold_lines)
-            ax.vlines(heats, ymin=ymin, ymax=ymax, linestyles=':', colors='k')
-        ax.autoscale()
-        fig.savefig(b, format="png")
+    return b.getvalue()
 
-        return b.getbuffer()
 
-    def create_tq(self, with_vlines = False) -> tuple[list[Line], list[Line], bytes]:
-        hot_lines, cold_lines = super().create_tq()
-        return hot_lines, cold_lines, self.draw(hot_lines, cold_lines, with_vlines)
+def render_tq(hot_lines: list[Line], cold_lines: list[Line]) -> tuple[bytes, bytes]:
+    b = io.BytesIO()
+    b_with_vlines = io.BytesIO()
 
-    def create_tq_separated(self, with_vlines = False) -> tuple[list[Line], list[Line], bytes]:
-        hot_lines, cold_lines = super().create_tq_separated()
-        return hot_lines, cold_lines, self.draw(hot_lines, cold_lines, with_vlines)
+    hot_segments, cold_segments = _segments(hot_lines, cold_lines)
 
-    def create_tq_split(self, with_vlines = False) -> tuple[list[Line], list[Line], bytes]:
-        hot_lines, cold_lines = super().create_tq_split()
-        return hot_lines, cold_lines, self.draw(hot_lines, cold_lines, with_vlines)
+    with _lock:
+        _draw_tq_lines(hot_segments, cold_segments)
+        _save_png(b)
+        _draw_vlines(hot_segments, cold_segments)
+        _save_png(b_with_vlines)
 
-    def create_tq_merged(self, with_vlines = False) -> tuple[list[Line], list[Line], bytes]:
-        hot_lines, cold_lines = super().create_tq_merged()
-        return hot_lines, cold_lines, self.draw(hot_lines, cold_lines, with_vlines)
+    return b.getvalue(), b_with_vlines.getvalue()
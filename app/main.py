@@ -1,20 +1,67 @@
-import base64
+import asyncio
+import hashlib
 import io
-import json
-import time
+import multiprocessing
+import os
+import struct
 import zipfile
-
-import pandas as pd
-from fastapi import Body, FastAPI, File, UploadFile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from typing import Literal
+
+import orjson
+import pybase64
+from fastapi import Body, FastAPI, File, Query, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import Response
+from pydantic import BaseModel, ValidationError
 from pyheatintegration import (PinchAnalyzer, PyHeatIntegrationError, Stream,
                                StreamState, StreamType,
                                get_possible_minimum_temp_diff_range)
 
-from .analyzer import Analyzer
+from .analyzer import render_grand_composite_curve, render_tq
+
+RENDER_WORKERS = max(1, min(int(os.getenv("RENDER_WORKERS", "2")), os.cpu_count() or 1))
+
+executor: ProcessPoolExecutor | None = None
+
+ARTIFICIAL_LATENCY = bool(os.getenv("DEBUG_ARTIFICIAL_LATENCY"))
+
+STREAM_TYPES = {type_.value: type_ for type_ in StreamType}
+STREAM_STATES = {state.value: state for state in StreamState}
+
+RESULT_CACHE_SIZE = 32
+RESULT_CACHE: OrderedDict[bytes, dict[str, dict[str, str] | bytes]] = OrderedDict()
+
+
+def start_executor() -> ProcessPoolExecutor:
+    global executor
+    # Workers are spawned rather than forked because the parent already runs
+    # the asyncio.to_thread worker threads by the time the pool starts.
+    executor = ProcessPoolExecutor(
+        max_workers=RENDER_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    return executor
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    pool = start_executor()
+    # Render a trivial plot on every worker so the spawn and matplotlib import
+    # cost is paid at startup rather than by the first /run.
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(
+        loop.run_in_executor(pool, render_grand_composite_curve, [0.0, 1.0], [0.0, 1.0])
+        for _ in range(RENDER_WORKERS)
+    ))
+    yield
+    executor.shutdown(cancel_futures=True)
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     'http://localhost:3000',
@@ -30,6 +77,20 @@ app.add_middleware(
 )
 
 
+def to_stream_type(value: int) -> StreamType:
+    try:
+        return STREAM_TYPES[value]
+    except KeyError:
+        return StreamType(value)
+
+
+def to_stream_state(value: int) -> StreamState:
+    try:
+        return STREAM_STATES[value]
+    except KeyError:
+        return StreamState(value)
+
+
 class StreamModel(BaseModel):
     id: str
     inputTemperature: float
@@ -46,8 +107,8 @@ class StreamModel(BaseModel):
             input_temperature=self.inputTemperature,
             output_temperature=self.outputTemperature,
             heat_load=self.heatLoad,
-            type_=StreamType(self.type),
-            state=StreamState(self.state),
+            type_=to_stream_type(self.type),
+            state=to_stream_state(self.state),
             cost=self.cost,
             reboiler_or_reactor=self.reboilerOrReactor
         )
@@ -57,6 +118,97 @@ class Streams(BaseModel):
     streams: list[StreamModel]
 
 
+def writestr_json(zip_file: zipfile.ZipFile, name: str, data: dict) -> None:
+    zip_file.writestr(
+        name,
+        orjson.dumps(data, option=orjson.OPT_INDENT_2),
+        compress_type=zipfile.ZIP_DEFLATED,
+        compresslevel=1,
+    )
+
+
+def result_cache_key(streams: list[StreamModel], minimum_temp_diff: float) -> bytes:
+    return hashlib.blake2b(
+        orjson.dumps([stream.model_dump() for stream in streams]) + struct.pack("<d", minimum_temp_diff),
+        digest_size=16,
+    ).digest()
+
+
+async def render(jobs: list[tuple]) -> list:
+    loop = asyncio.get_running_loop()
+    pool = executor or start_executor()
+    try:
+        return await asyncio.gather(*(loop.run_in_executor(pool, *job) for job in jobs))
+    except BrokenProcessPool:
+        # A dead worker breaks the whole pool, so replace it (unless another
+        # request already did) and retry once.
+        if executor is pool:
+            pool.shutdown(wait=False)
+            start_executor()
+        return await asyncio.gather(*(loop.run_in_executor(executor, *job) for job in jobs))
+
+
+async def analyze(streams: list[StreamModel], minimum_temp_diff: float) -> tuple[dict[str, bytes], bytes]:
+    analyzer = await asyncio.to_thread(
+        PinchAnalyzer, [stream.convert() for stream in streams], minimum_temp_diff
+    )
+
+    gcc_heats, gcc_temps = analyzer.create_grand_composite_curve()
+    hot_lines, cold_lines = analyzer.create_tq()
+    hot_lines_separated, cold_lines_separated = analyzer.create_tq_separated()
+    hot_lines_split, cold_lines_split = analyzer.create_tq_split()
+    hot_lines_merged, cold_lines_merged = analyzer.create_tq_merged()
+
+    jobs = [
+        (render_grand_composite_curve, gcc_heats, gcc_temps),
+        (render_tq, hot_lines, cold_lines),
+        (render_tq, hot_lines_separated, cold_lines_separated),
+        (render_tq, hot_lines_split, cold_lines_split),
+        (render_tq, hot_lines_merged, cold_lines_merged),
+    ]
+    (
+        buf_gcc,
+        (buf_tq, buf_tq_with_vlines),
+        (buf_tq_separated, buf_tq_separated_with_vlines),
+        (buf_tq_split, buf_tq_split_with_vlines),
+        (buf_tq_merged, buf_tq_merged_with_vlines),
+    ) = await render(jobs)
+
+    b = io.BytesIO()
+    with zipfile.ZipFile(b, "w", compression=zipfile.ZIP_STORED) as myzip:
+        myzip.writestr("gcc.png", buf_gcc)
+
+        myzip.writestr("tq.png", buf_tq)
+        myzip.writestr("tq_with_vlines.png", buf_tq_with_vlines)
+        writestr_json(myzip, "tq.json", {"hot_lines": hot_lines, "cold_lines": cold_lines})
+
+        myzip.writestr("tq_separated.png", buf_tq_separated)
+        myzip.writestr("tq_separated_with_vlines.png", buf_tq_separated_with_vlines)
+        writestr_json(myzip, "tq_separeted.json", {"hot_lines": hot_lines_separated, "cold_lines": cold_lines_separated})
+
+        myzip.writestr("tq_split.png", buf_tq_split)
+        myzip.writestr("tq_split_with_vlines.png", buf_tq_split_with_vlines)
+        writestr_json(myzip, "tq_split.json", {"hot_lines": hot_lines_split, "cold_lines": cold_lines_split})
+
+        myzip.writestr("tq_merged.png", buf_tq_merged)
+        myzip.writestr("tq_merged_with_vlines.png", buf_tq_merged_with_vlines)
+        writestr_json(myzip, "tq_merged.json", {"hot_lines": hot_lines_merged, "cold_lines": cold_lines_merged})
+
+    images = {
+        "gcc": buf_gcc,
+        "tq": buf_tq,
+        "tq_with_vlines": buf_tq_with_vlines,
+        "tq_separated": buf_tq_separated,
+        "tq_separated_with_vlines": buf_tq_separated_with_vlines,
+        "tq_split": buf_tq_split,
+        "tq_split_with_vlines": buf_tq_split_with_vlines,
+        "tq_merged": buf_tq_merged,
+        "tq_merged_with_vlines": buf_tq_merged_with_vlines,
+    }
+
+    return images, b.getvalue()
+
+
 @app.get("/")
 def root():
     return {"message": "Hello, world."}
@@ -64,36 +216,32 @@ def root():
 
 @app.post("/upload")
 async def upload(file: UploadFile = File(...)):
-    time.sleep(1)
-    data = json.loads(file.file.read())
-    df = pd.DataFrame(data['streams'])
+    if ARTIFICIAL_LATENCY:
+        await asyncio.sleep(1)
 
     try:
-        streams = [
-            Stream(
-                row.inputTemperature,
-                row.outputTemperature,
-                row.heatLoad,
-                StreamType(row.type),
-                StreamState(row.state),
-                row.cost,
-                row.reboilerOrReactor,
-                row.id
-            ) for row in df.itertuples()
-        ]
+        data = Streams.model_validate_json(await file.read())
+    except ValidationError as e:
+        return {
+            "succeeded": False,
+            "message": str(e),
+        }
+
+    try:
+        streams = [stream.convert() for stream in data.streams]
     except PyHeatIntegrationError as e:
         return {
             "succeeded": False,
             "message": str(e),
         }
 
-    if message := PinchAnalyzer.validate_streams(streams):
+    if message := await asyncio.to_thread(PinchAnalyzer.validate_streams, streams):
         return {
             "succeeded": False,
             "message": message,
         }
 
-    possible_minimum_temp_diff_range = get_possible_minimum_temp_diff_range(streams)
+    possible_minimum_temp_diff_range = await asyncio.to_thread(get_possible_minimum_temp_diff_range, streams)
 
     return {
         "succeeded": True,
@@ -101,13 +249,14 @@ async def upload(file: UploadFile = File(...)):
             "min": possible_minimum_temp_diff_range.start,
             "max": possible_minimum_temp_diff_range.finish,
         },
-        "streams": json.loads(df.to_json(orient='records', force_ascii=False)),
+        "streams": [stream.model_dump() for stream in data.streams],
     }
 
 
 @app.post("/validate")
 async def validate(streams: Streams):
-    time.sleep(1)
+    if ARTIFICIAL_LATENCY:
+        await asyncio.sleep(1)
 
     try:
         streams_ = [stream.convert() for stream in streams.streams]
@@ -117,13 +266,13 @@ async def validate(streams: Streams):
             "message": str(e),
         }
 
-    if message := PinchAnalyzer.validate_streams(streams_):
+    if message := await asyncio.to_thread(PinchAnalyzer.validate_streams, streams_):
         return {
             "succeeded": False,
             "message": message,
         }
 
-    possible_minimum_temp_diff_range = get_possible_minimum_temp_diff_range(streams_)
+    possible_minimum_temp_diff_range = await asyncio.to_thread(get_possible_minimum_temp_diff_range, streams_)
 
     return {
         "succeeded": True,
@@ -135,63 +284,40 @@ async def validate(streams: Streams):
 
 
 @app.post("/run")
-async def run(streams: list[StreamModel], minimumTempDiff: float = Body(...)):
+async def run(
+    streams: list[StreamModel],
+    minimumTempDiff: float = Body(...),
+    format_: Literal["images", "zip"] = Query("images", alias="format"),
+):
     """Entry point to draw graph.py"""
     minimum_temp_diff = minimumTempDiff
 
     try:
-        analyzer = Analyzer([stream.convert() for stream in streams], minimum_temp_diff)
-
-        buf_gcc = analyzer.create_grand_composite_curve()
-
-        hot_lines, cold_lines, buf_tq = analyzer.create_tq()
-        _, _, buf_tq_with_vlines = analyzer.create_tq(True)
-
-        hot_lines_separated, cold_lines_separated, buf_tq_separated = analyzer.create_tq_separated()
-        _, _, buf_tq_separated_with_vlines = analyzer.create_tq_separated(True)
-
-        hot_lines_split, cold_lines_split, buf_tq_split = analyzer.create_tq_split()
-        _, _, buf_tq_split_with_vlines = analyzer.create_tq_split(True)
-
-        hot_lines_merged, cold_lines_merged, buf_tq_merged = analyzer.create_tq_merged()
-        _, _, buf_tq_merged_with_vlines = analyzer.create_tq_merged(True)
-
-        b = io.BytesIO()
-        with zipfile.ZipFile(b, "w") as myzip:
-            myzip.writestr("gcc.png", buf_gcc)
-
-            myzip.writestr("tq.png", buf_tq)
-            myzip.writestr("tq_with_vlines.png", buf_tq_with_vlines)
-            myzip.writestr("tq.json", json.dumps({"hot_lines": hot_lines, "cold_lines": cold_lines}, indent=2))
-
-            myzip.writestr("tq_separated.png", buf_tq_separated)
-            myzip.writestr("tq_separated_with_vlines.png", buf_tq_separated_with_vlines)
-            myzip.writestr("tq_separeted.json", json.dumps({"hot_lines": hot_lines_separated, "cold_lines": cold_lines_separated}, indent=2))
-
-            myzip.writestr("tq_split.png", buf_tq_split)
-            myzip.writestr("tq_split_with_vlines.png", buf_tq_split_with_vlines)
-            myzip.writestr("tq_split.json", json.dumps({"hot_lines": hot_lines_split, "cold_lines": cold_lines_split}, indent=2))
-
-            myzip.writestr("tq_merged.png", buf_tq_merged)
-            myzip.writestr("tq_merged_with_vlines.png", buf_tq_merged_with_vlines)
-            myzip.writestr("tq_merged.json", json.dumps({"hot_lines": hot_lines_merged, "cold_lines": cold_lines_merged}, indent=2))
-
-        b.seek(0)
+        key = result_cache_key(streams, minimum_temp_diff)
+        if (result := RESULT_CACHE.get(key)) is not None:
+            RESULT_CACHE.move_to_end(key)
+        else:
+            images, archive = await analyze(streams, minimum_temp_diff)
+            # Keep each format's payload ready to send so a cache hit does no
+            # encoding at all.
+            result = {
+                "images": {name: pybase64.b64encode_as_string(image) for name, image in images.items()},
+                "zip": archive,
+            }
+            RESULT_CACHE[key] = result
+            if len(RESULT_CACHE) > RESULT_CACHE_SIZE:
+                RESULT_CACHE.popitem(last=False)
+
+        if format_ == "zip":
+            return Response(
+                result["zip"],
+                media_type="application/zip",
+                headers={"Content-Disposition": 'attachment; filename="result.zip"'},
+            )
 
         return {
             "succeeded": True,
-            "zip": base64.b64encode(b.getvalue()).decode(),
-            "images": {
-                "gcc": base64.b64encode(buf_gcc).decode(),
-                "tq": base64.b64encode(buf_tq).decode(),
-                "tq_with_vlines": base64.b64encode(buf_tq_with_vlines).decode(),
-                "tq_separated": base64.b64encode(buf_tq_separated).decode(),
-                "tq_separated_with_vlines": base64.b64encode(buf_tq_separated_with_vlines).decode(),
-                "tq_split": base64.b64encode(buf_tq_split).decode(),
-                "tq_split_with_vlines": base64.b64encode(buf_tq_split_with_vlines).decode(),
-                "tq_merged": base64.b64encode(buf_tq_merged).decode(),
-                "tq_merged_with_vlines": base64.b64encode(buf_tq_merged_with_vlines).decode(),
-            },
+            "images": result["images"],
         }
     except PyHeatIntegrationError as e:
         return {